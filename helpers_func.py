@@ -2,19 +2,106 @@ import logging
 from datetime import datetime
 import streamlit as st
 import os
+import glob
 from pathlib import Path
 import sqlite3
+import threading
+import queue
+from contextlib import contextmanager
+
+try:
+    import sqlite_vec
+except ImportError:  # semantic response cache is disabled without it
+    sqlite_vec = None
 
 UPLOAD_DIRECTORY = "./processed_docs"
+UPLOAD_DIR = Path(UPLOAD_DIRECTORY)
 DB_PATH = "./chat_data.sqlite3"
+WAL_CHECKPOINT_BYTES = 4 * 1024 * 1024
+# Semantic response cache (sqlite-vec): embedding size of nomic-embed-text and max cosine distance for a hit
+QUERY_CACHE_DIM = 768
+QUERY_CACHE_MAX_DISTANCE = 0.05
+QUERY_CACHE_MAX_ROWS = 1000
+# Idle reader connections kept open alongside the single writer connection
+READ_POOL_SIZE = 4
 
 # Create upload directory if it doesn't exist
-os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
+UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+
+# Serializes writers on the shared connection
+_write_lock = threading.Lock()
+# Idle reader connections; readers never share the writer's connection, so they only see committed rows
+_read_pool = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+
+def _open_conn():
+    """Open a tuned SQLite connection to DB_PATH."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    # Rows convert straight to dicts keyed by column name
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside writes; the mode is stored in the DB file itself
+    if DB_PATH != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Per-connection tuning: ~20 MB page cache, in-memory temp tables, 256 MB mmap window
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    if sqlite_vec is not None:
+        try:
+            conn.enable_load_extension(True)
+            sqlite_vec.load(conn)
+            conn.enable_load_extension(False)
+        except Exception as e:
+            logging.warning(f"sqlite-vec unavailable, semantic query cache disabled: {e}")
+    return conn
+
+@st.cache_resource
+def _get_conn():
+    """Return the process-wide writer connection; callers hold _write_lock while using it."""
+    return _open_conn()
+
+@contextmanager
+def _read_conn():
+    """Borrow a reader connection from the pool (opening one if none is idle) and return it afterwards."""
+    if DB_PATH == ":memory:":
+        # A private in-memory DB per connection would be empty, so read through the writer
+        with _write_lock:
+            yield _get_conn()
+        return
+    try:
+        conn = _read_pool.get_nowait()
+    except queue.Empty:
+        conn = _open_conn()
+    try:
+        yield conn
+    finally:
+        try:
+            _read_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def _query_cache_enabled(conn):
+    """True if sqlite-vec is loaded on this connection (checked on the connection, not module state)."""
+    try:
+        conn.execute("SELECT vec_version()")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def _maybe_checkpoint(conn):
+    """Fold the WAL back into the DB and truncate it once it grows past WAL_CHECKPOINT_BYTES."""
+    try:
+        wal_path = DB_PATH + "-wal"
+        if os.path.exists(wal_path) and os.path.getsize(wal_path) > WAL_CHECKPOINT_BYTES:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except Exception as e:
+        logging.error(f"WAL checkpoint failed: {e}")
 
 def _init_db():
     """Initialize SQLite DB for chat sessions and messages."""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        conn = _get_conn()
+        with _write_lock:
             cur = conn.cursor()
             cur.execute(
                 """
@@ -23,7 +110,8 @@ def _init_db():
                     created_at TEXT NOT NULL,
                     document_path TEXT,
                     document_unique_name TEXT,
-                    document_display_name TEXT
+                    document_display_name TEXT,
+                    document_hash TEXT
                 )
                 """
             )
@@ -41,7 +129,21 @@ def _init_db():
                 )
                 """
             )
-            conn.commit()
+            # Serves the latest-answer lookup in get_chat_sessions and chat_id filters/deletes
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_msg_chat_id ON chat_messages(chat_id, id DESC)"
+            )
+            if _query_cache_enabled(conn):
+                cur.execute(
+                    f"""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS query_cache USING vec0(
+                        collection text,
+                        embedding float[{QUERY_CACHE_DIM}] distance_metric=cosine,
+                        +response text,
+                        +chat_id integer
+                    )
+                    """
+                )
             # Add missing columns in case table existed from older version
             cur.execute("PRAGMA table_info(chat_sessions)")
             existing_cols = {row[1] for row in cur.fetchall()}
@@ -51,7 +153,8 @@ def _init_db():
                 cur.execute("ALTER TABLE chat_sessions ADD COLUMN document_unique_name TEXT")
             if "document_display_name" not in existing_cols:
                 cur.execute("ALTER TABLE chat_sessions ADD COLUMN document_display_name TEXT")
-            conn.commit()
+            if "document_hash" not in existing_cols:
+                cur.execute("ALTER TABLE chat_sessions ADD COLUMN document_hash TEXT")
     except Exception as e:
         logging.error(f"Failed to initialize DB: {e}")
 
@@ -69,7 +172,7 @@ def clear_logs():
     st.session_state.process_logs = []
 
 def add_to_chat_history(question, answer, response_time, doc_name):
-    """Add question and answer to chat history"""
+    """Add question and answer to chat history. Returns the committed chat_id, or None if not persisted."""
     chat_entry = {
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "question": question,
@@ -81,26 +184,26 @@ def add_to_chat_history(question, answer, response_time, doc_name):
 
     # Persist to DB under current chat session
     try:
-        # Ensure a chat session exists
-        if 'chat_id' not in st.session_state or st.session_state.get('chat_id') is None:
-            with sqlite3.connect(DB_PATH) as conn:
-                cur = conn.cursor()
+        conn = _get_conn()
+        chat_id = st.session_state.get('chat_id')
+        # Session INSERT, message INSERT and metadata UPDATE share one transaction (one disk flush)
+        with _write_lock, conn:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            # Ensure a chat session exists
+            if chat_id is None:
                 cur.execute(
                     "INSERT INTO chat_sessions(created_at) VALUES (?)",
                     (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),)
                 )
-                st.session_state.chat_id = cur.lastrowid
-                conn.commit()
-
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
+                chat_id = cur.lastrowid
             cur.execute(
                 """
                 INSERT INTO chat_messages(chat_id, timestamp, question, answer, response_time, document)
                 VALUES (?, ?, ?, ?, ?, ?)
                 """,
                 (
-                    st.session_state.chat_id,
+                    chat_id,
                     chat_entry["timestamp"],
                     chat_entry["question"],
                     chat_entry["answer"],
@@ -114,27 +217,31 @@ def add_to_chat_history(question, answer, response_time, doc_name):
                     cur.execute(
                         """
                         UPDATE chat_sessions
-                        SET document_path = ?, document_unique_name = ?, document_display_name = ?
+                        SET document_path = ?, document_unique_name = ?, document_display_name = ?, document_hash = ?
                         WHERE id = ?
                         """,
                         (
                             st.session_state.current_document.get('path'),
                             st.session_state.current_document.get('unique_name'),
                             st.session_state.current_document.get('name'),
-                            st.session_state.chat_id,
+                            st.session_state.current_document.get('hash'),
+                            chat_id,
                         ),
                     )
             except Exception as e:
                 logging.error(f"Failed to update chat session doc metadata: {e}")
-            conn.commit()
+        st.session_state.chat_id = chat_id
+        return chat_id
     except Exception as e:
         logging.error(f"Failed to persist chat message: {e}")
+        return None
 
 def start_new_chat_session():
     """Start a new chat within the same session (keeps current document/vector DB). Returns new chat_id."""
     new_chat_id = None
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        conn = _get_conn()
+        with _write_lock:
             cur = conn.cursor()
             cur.execute(
                 "INSERT INTO chat_sessions(created_at) VALUES (?)",
@@ -142,7 +249,6 @@ def start_new_chat_session():
             )
             new_chat_id = cur.lastrowid
             st.session_state.chat_id = new_chat_id
-            conn.commit()
     except Exception as e:
         logging.error(f"Failed to create new chat session: {e}")
 
@@ -161,7 +267,7 @@ def start_new_chat_session():
 def get_chat_sessions():
     """Return list of chat sessions sorted by newest first."""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with _read_conn() as conn:
             cur = conn.cursor()
             cur.execute(
                 """
@@ -178,16 +284,7 @@ def get_chat_sessions():
                 ORDER BY s.id DESC
                 """
             )
-            rows = cur.fetchall()
-            sessions = [
-                {
-                    "id": r[0],
-                    "document_display_name": r[1],
-                    "last_answer": r[2],
-                }
-                for r in rows
-            ]
-            return sessions
+            return [dict(r) for r in cur]
     except Exception as e:
         logging.error(f"Failed to fetch chat sessions: {e}")
         return []
@@ -195,7 +292,7 @@ def get_chat_sessions():
 def get_chat_messages(chat_id):
     """Return messages for a chat session (oldest first)."""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with _read_conn() as conn:
             cur = conn.cursor()
             cur.execute(
                 """
@@ -206,39 +303,44 @@ def get_chat_messages(chat_id):
                 """,
                 (chat_id,),
             )
-            rows = cur.fetchall()
-            messages = [
-                {
-                    "timestamp": r[0],
-                    "question": r[1],
-                    "answer": r[2],
-                    "response_time": r[3],
-                    "document": r[4],
-                }
-                for r in rows
-            ]
-            return messages
+            return [dict(r) for r in cur]
     except Exception as e:
         logging.error(f"Failed to fetch chat messages: {e}")
         return []
 
+def get_chat_version(chat_id):
+    """Return a cheap change token for a chat's messages (latest message id, 0 if none)."""
+    try:
+        with _read_conn() as conn:
+            row = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM chat_messages WHERE chat_id = ?",
+                (chat_id,),
+            ).fetchone()
+            return row[0]
+    except Exception as e:
+        logging.error(f"Failed to fetch chat version: {e}")
+        return None
+
 def get_chat_metadata(chat_id):
     """Return stored document metadata for a chat session."""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with _read_conn() as conn:
             cur = conn.cursor()
             cur.execute(
-                "SELECT document_path, document_unique_name, document_display_name FROM chat_sessions WHERE id = ?",
+                """
+                SELECT document_path AS path,
+                       document_unique_name AS unique_name,
+                       document_display_name AS name,
+                       document_hash AS hash
+                FROM chat_sessions
+                WHERE id = ?
+                """,
                 (chat_id,),
             )
             row = cur.fetchone()
             if not row:
                 return None
-            return {
-                "path": row[0],
-                "unique_name": row[1],
-                "name": row[2],
-            }
+            return dict(row)
     except Exception as e:
         logging.error(f"Failed to fetch chat metadata: {e}")
         return None
@@ -246,41 +348,101 @@ def get_chat_metadata(chat_id):
 def delete_chat_session(chat_id: int) -> None:
     """Delete a chat session and all of its messages."""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM chat_messages WHERE chat_id = ?", (chat_id,))
-            cur.execute("DELETE FROM chat_sessions WHERE id = ?", (chat_id,))
-            conn.commit()
+        conn = _get_conn()
+        with _write_lock:
+            with conn:
+                cur = conn.cursor()
+                cur.execute("BEGIN")
+                cur.execute("DELETE FROM chat_messages WHERE chat_id = ?", (chat_id,))
+                cur.execute("DELETE FROM chat_sessions WHERE id = ?", (chat_id,))
+                # Answers from a deleted chat must not keep being served to other chats
+                if _query_cache_enabled(conn):
+                    cur.execute("DELETE FROM query_cache WHERE chat_id = ?", (chat_id,))
+            # Checkpoint outside the transaction, while still holding the writer lock
+            _maybe_checkpoint(conn)
     except Exception as e:
         logging.error(f"Failed to delete chat session {chat_id}: {e}")
 
+def get_cached_response(collection, query_embedding):
+    """Return a stored answer for a semantically near-identical question on the same document, or None."""
+    try:
+        with _read_conn() as conn:
+            if not _query_cache_enabled(conn):
+                return None
+            row = conn.execute(
+                """
+                SELECT response, distance
+                FROM query_cache
+                WHERE embedding MATCH ? AND k = 1 AND collection = ?
+                """,
+                (sqlite_vec.serialize_float32(query_embedding), collection),
+            ).fetchone()
+            if row and row["distance"] < QUERY_CACHE_MAX_DISTANCE:
+                return row["response"]
+    except Exception as e:
+        logging.error(f"Failed to query semantic cache: {e}")
+    return None
+
+def cache_response(collection, query_embedding, response, chat_id):
+    """Store an answer keyed by its question embedding for get_cached_response."""
+    try:
+        conn = _get_conn()
+        if not _query_cache_enabled(conn):
+            return
+        with _write_lock, conn:
+            cur = conn.cursor()
+            cur.execute("BEGIN")
+            cur.execute(
+                "INSERT INTO query_cache(collection, embedding, response, chat_id) VALUES (?, ?, ?, ?)",
+                (collection, sqlite_vec.serialize_float32(query_embedding), response, chat_id),
+            )
+            # Cap the table: drop the oldest rows past QUERY_CACHE_MAX_ROWS
+            cur.execute(
+                """
+                DELETE FROM query_cache
+                WHERE rowid IN (
+                    SELECT rowid FROM query_cache
+                    ORDER BY rowid
+                    LIMIT max(0, (SELECT COUNT(*) FROM query_cache) - ?)
+                )
+                """,
+                (QUERY_CACHE_MAX_ROWS,),
+            )
+    except Exception as e:
+        logging.error(f"Failed to store semantic cache entry: {e}")
+
 def save_uploaded_file(uploaded_file):
-    """Save uploaded file to temporary directory"""
+    """Save uploaded file to temporary directory. Returns (file_path, unique_filename, written); written is False if an existing file was reused."""
     try:
         timestamp = datetime.now().strftime("%Y%m%d")
-        file_extension = Path(uploaded_file.name).suffix
-        original_name = Path(uploaded_file.name).stem
+        upload_name = Path(uploaded_file.name)
+        file_extension = upload_name.suffix
+        original_name = upload_name.stem
 
-        # check if a file with the same original name exists (need to update it!)
-        if os.path.exists(UPLOAD_DIRECTORY):
-            existing_files = os.listdir(UPLOAD_DIRECTORY)
-            for current_file in existing_files:
-                if current_file.startswith(f"{original_name}_"):
-                    existing_path = os.path.join(UPLOAD_DIRECTORY, current_file).replace(os.sep, '/')
-                    add_log(f"SAME Document found in memory: {current_file}")
-                    return existing_path, current_file
         # Create unique filename and path in memory
         unique_filename = f"{original_name}_{timestamp}{file_extension}"
-        file_path = os.path.join(UPLOAD_DIRECTORY, unique_filename).replace(os.sep, '/')
+        target = UPLOAD_DIR / unique_filename
+        file_path = target.as_posix()
+
+        # check if a file with the same original name exists (need to update it!)
+        # Filenames are deterministic, so try today's name directly before globbing older dates
+        if target.exists():
+            existing = target
+        else:
+            pattern = f"{glob.escape(original_name)}_*{glob.escape(file_extension)}"
+            existing = next(UPLOAD_DIR.glob(pattern), None)
+        if existing is not None:
+            add_log(f"SAME Document found in memory: {existing.name}")
+            return existing.as_posix(), existing.name, False
 
         # create directory if it don't exist
-        os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
+        UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
         # save the file
         with open(file_path, "wb") as f:
             f.write(uploaded_file.getbuffer())
         add_log(f"This file: {unique_filename}, got the FIRST time")
         add_log(f"File saved successfully: {unique_filename}")
-        return file_path, unique_filename
+        return file_path, unique_filename, True
     except Exception as e:
         add_log(f"Error saving file: {str(e)}", "ERROR")
-        return None, None
\ No newline at end of file
+        return None, None, False
\ No newline at end of file
@@ -0,0 +1,4 @@
+# Constants for AI Models, kept free of heavy imports so the UI can read them
+# without loading the RAG stack
+MODEL_NAME = "codegemma:latest"
+EMBEDDING_MODEL = "nomic-embed-text"
@@ -1,7 +1,12 @@
 import os
+import re
 import logging
 import time
 import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import streamlit as st
 import ollama
 from langchain_community.document_loaders import UnstructuredPDFLoader, CSVLoader, TextLoader
@@ -16,17 +21,67 @@ from helpers_func import (
     clear_logs,
     add_to_chat_history,
     save_uploaded_file,
+    get_cached_response,
+    cache_response,
 )
+from rag_constants import MODEL_NAME, EMBEDDING_MODEL
 
-# Constants for AI Models and Chroma DB
-MODEL_NAME = "codegemma:latest" 
-EMBEDDING_MODEL = "nomic-embed-text"
+# Constants for Chroma DB
 PERSIST_DIRECTORY = "./chroma_db"
+# HNSW index settings, only applied when a collection is first created
+HNSW_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+}
+# Number of chunks retrieved per question (similarity search)
+RETRIEVER_K = 5
+EMBED_BATCH_SIZE = 64
+EMBED_WORKERS = 4
+CONTEXT_CACHE_SIZE = 128
+# Per-session approximate query cache: entries per document and max cosine distance for a hit
+SESSION_QUERY_CACHE_SIZE = 64
+SESSION_QUERY_CACHE_MAX_DISTANCE = 0.05
+# Random-projection LSH over the session query cache: independent tables x signature bits
+LSH_TABLES = 4
+LSH_BITS = 16
+_LSH_BIT_WEIGHTS = 1 << np.arange(LSH_BITS, dtype=np.int64)
+
+# LRU of (collection, query) -> (joined context, retrieved docs), shared across sessions
+_context_cache = OrderedDict()
+_context_cache_lock = threading.Lock()
+
+# Process-wide chat model, set by preload_model or the background warm-up
+_llm = None
+_llm_lock = threading.Lock()
+
+# Built once; splitting uses C-level re.split per separator and len() for sizing,
+# which is cheaper than a tokenizer-based length function
+_TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=1800,
+    chunk_overlap=400,
+    separators=["\n\n", "\n", ". ", " ", ""],
+    length_function=len,
+)
+
+# Matches a meaningful chunk line and captures it stripped (see Retrieved Context expander)
+_CONTENT_LINE_RE = re.compile(r'^[^\S\n]*(?!\d+[^\S\n]*$)(\S.{9,}\S)[^\S\n]*$', re.M)
 
 
 def get_file_hash(file_content):
     """Generate hash for uploaded file to detect changes"""
-    return hashlib.md5(file_content).hexdigest()
+    # Only used for change detection and collection naming, so a fast non-crypto digest is enough
+    return hashlib.blake2b(file_content, digest_size=8).hexdigest()
+
+def get_file_hash_from_path(doc_path, chunk_size=1 << 20):
+    """Hash a file on disk in fixed-size chunks so memory stays bounded"""
+    h = hashlib.blake2b(digest_size=8)
+    buf = bytearray(chunk_size)
+    mv = memoryview(buf)
+    with open(doc_path, 'rb') as f:
+        while (n := f.readinto(mv)):
+            h.update(mv[:n])
+    return h.hexdigest()
 
 def ingest_docs(doc_path):
     """Load documents for supported file types: PDF, CSV, JSON, TXT"""
@@ -73,33 +128,70 @@ def ingest_docs(doc_path):
 def split_documents(documents):
     """Split documents into smaller chunks with better parameters for detailed content"""
     add_log("Starting document splitting process...")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1800,  
-        chunk_overlap=400, 
-        separators=["\n\n", "\n", ". ", " ", ""], 
-        length_function=len,
-    )
-    chunks = text_splitter.split_documents(documents)
+    chunks = _TEXT_SPLITTER.split_documents(documents)
     add_log(f"Documents split into {len(chunks)} chunks with improved parameters")
     return chunks
 
-def create_vector_db_from_document(doc_path):
-    """Create vector database from uploaded document"""
+@st.cache_resource
+def get_embedding_model():
+    """Pull the embedding model once per process and reuse the client across reruns"""
+    ollama.pull(EMBEDDING_MODEL)
+    return OllamaEmbeddings(
+        model=EMBEDDING_MODEL,
+        num_gpu=1
+    )
+
+def embed_and_upsert_batched(embedding, collection, collection_name, texts, metadatas):
+    """Embed texts in fixed-size batches from parallel workers and upsert each batch as it is ready"""
+    starts = range(0, len(texts), EMBED_BATCH_SIZE)
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in starts]
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as ex:
+        # map preserves batch order, so vectors line up with texts; upserting per batch keeps
+        # every call under chromadb's max_batch_size
+        for start, batch, vectors in zip(starts, batches, ex.map(embedding.embed_documents, batches)):
+            # Ids are deterministic per collection, so re-ingesting the same document overwrites
+            # its chunks instead of duplicating them
+            collection.upsert(
+                ids=[f"{collection_name}-{i}" for i in range(start, start + len(batch))],
+                embeddings=vectors,
+                documents=batch,
+                metadatas=metadatas[start:start + len(batch)],
+            )
+
+def create_vector_db_from_document(doc_path, collection_hash=None):
+    """Create vector database from uploaded document.
+
+    collection_hash: precomputed file hash prefix; hashed from disk when not given.
+    """
     add_log("Creating vector database from uploaded document...")
     
     add_log(f"Ensuring embedding model is available: {EMBEDDING_MODEL}")
     try:
-        ollama.pull(EMBEDDING_MODEL)
+        embedding = get_embedding_model()
         add_log("Embedding model ready")
     except Exception as e:
         add_log(f"Error pulling embedding model: {str(e)}", "ERROR")
         st.error(str(e))
         return None
 
-    embedding = OllamaEmbeddings(
-        model=EMBEDDING_MODEL,
-        num_gpu=1
-    )
+    try:
+        if collection_hash is None:
+            collection_hash = get_file_hash_from_path(doc_path)[:8]
+        collection_name = f"doc_{collection_hash}"
+
+        # Same file hash -> same collection, so reuse vectors persisted by an earlier run
+        vector_db = Chroma(
+            collection_name=collection_name,
+            embedding_function=embedding,
+            persist_directory=PERSIST_DIRECTORY,
+            collection_metadata=HNSW_COLLECTION_METADATA,
+        )
+        if vector_db._collection.count() > 0:
+            add_log(f"Reusing persisted vector database: {collection_name}")
+            return vector_db
+    except Exception as e:
+        add_log(f"Error opening persisted vector database: {str(e)}", "ERROR")
+        return None
 
     data = ingest_docs(doc_path)
     if data is None:
@@ -109,28 +201,30 @@ def create_vector_db_from_document(doc_path):
 
     add_log("Creating vector database from document chunks...")
     try:
-        collection_name = f"doc_{get_file_hash(open(doc_path, 'rb').read())[:8]}"
-        
-        vector_db = Chroma.from_documents(
-            documents=chunks,
-            embedding=embedding,
-            collection_name=collection_name,
-        )
+        texts = [c.page_content for c in chunks]
+        metadatas = [c.metadata for c in chunks]
+        add_log(f"Embedding {len(texts)} chunks in batches of {EMBED_BATCH_SIZE} ({EMBED_WORKERS} workers)")
+        # vector_db is the empty persisted collection opened above
+        embed_and_upsert_batched(embedding, vector_db._collection, collection_name, texts, metadatas)
         add_log("Vector database created successfully")
         return vector_db
     except Exception as e:
         add_log(f"Error creating vector database: {str(e)}", "ERROR")
         return None
 
-def create_fast_retriever(vector_db):
-    """Create a retriever that gets more relevant chunks for detailed responses"""
-    add_log("Creating enhanced similarity retriever")
-    retriever = vector_db.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": 5} 
-    )
-    add_log("Enhanced retriever created (k = 5 similarity search)")
-    return retriever
+@st.cache_resource
+def get_vector_db_for_path(doc_path, mtime, embedding_model, collection_hash=None):
+    """Return the vector DB for a saved document, cached per (path, mtime, embedding model).
+
+    Used when switching chats so reselecting a chat reuses the already-opened store.
+    collection_hash: hash stored with the chat; lets the persisted collection be opened
+    without re-reading the document.
+    """
+    vector_db = create_vector_db_from_document(doc_path, collection_hash=collection_hash)
+    if vector_db is None:
+        # Raise so the failure is not cached and the next switch retries
+        raise RuntimeError(f"Failed to build vector database for {doc_path}")
+    return vector_db
 
 def create_chain(llm):
     """Create the RAG chain"""
@@ -155,29 +249,144 @@ User Question: {question}
     return chain
 
 @st.cache_resource
+def get_rag_chain(model_name, _model):
+    """Return the RAG chain for a model, built once and reused across queries"""
+    return create_chain(_model)
+
+def _load_model():
+    """Create the chat model and run a warm-up query"""
+    llm = ChatOllama(
+        model=MODEL_NAME,
+        num_gpu=1,
+        temperature=0.1,
+        num_thread=4
+    )
+    llm.invoke("Hello")
+    return llm
+
 def preload_model():
     """Preload the model for faster response"""
+    global _llm
+    # Fast path: plain global read, no cache hashing or locking once the model is warm
+    if _llm is not None:
+        return _llm
     add_log(f"Preloading model: {MODEL_NAME}")
     try:
-        llm = ChatOllama(
-            model=MODEL_NAME,
-            num_gpu=1,
-            temperature=0.1,
-            num_thread=4
-        )
-        add_log("Warming up the model with test query...")
-        llm.invoke("Hello")
+        with _llm_lock:
+            if _llm is None:
+                add_log("Warming up the model with test query...")
+                _llm = _load_model()
         add_log("Model preloaded and warmed up successfully")
-        return llm
+        return _llm
     except Exception as e:
         add_log(f"Model preload failed: {str(e)}", "ERROR")
         st.error(f"Model preload failed: {str(e)}")
         return None
 
+def _warm_model_in_background():
+    """Load the model off the script thread so queries do not pay the warm-up"""
+    global _llm
+    try:
+        with _llm_lock:
+            if _llm is None:
+                _llm = _load_model()
+    except Exception as e:
+        # preload_model retries and reports the error on the first query
+        logging.warning(f"Background model warm-up failed: {e}")
+
+def start_model_warmup():
+    """Start loading the model in a background thread unless it is loaded or already loading"""
+    if _llm is None and not _llm_lock.locked():
+        threading.Thread(target=_warm_model_in_background, daemon=True).start()
+
+start_model_warmup()
+
 def format_docs(docs):
     """Format documents for context"""
     return "\n\n".join(doc.page_content for doc in docs)
 
+def _context_cache_key(vector_db, query):
+    """Key retrieval results on the collection and the whitespace/case-normalized query"""
+    return vector_db._collection.name, " ".join(query.lower().split())
+
+def get_cached_context(key):
+    """Return (context, docs) for a previously seen query, or None"""
+    with _context_cache_lock:
+        hit = _context_cache.get(key)
+        if hit is not None:
+            _context_cache.move_to_end(key)
+        return hit
+
+def cache_context(key, context, docs):
+    """Store the joined context and its docs, evicting the least recently used entry"""
+    with _context_cache_lock:
+        _context_cache[key] = (context, docs)
+        _context_cache.move_to_end(key)
+        while len(_context_cache) > CONTEXT_CACHE_SIZE:
+            _context_cache.popitem(last=False)
+
+def _unit_vector(vec):
+    """Return vec as a float32 array scaled to unit L2 norm"""
+    v = np.asarray(vec, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    return v / norm if norm else v
+
+def _lsh_keys(unit_vec):
+    """Bucket key per LSH table: sign bits of random-hyperplane projections packed into an int"""
+    planes = st.session_state.get('lsh_planes')
+    if planes is None or planes.shape[1] != unit_vec.shape[0]:
+        # Fixed seed so the hash functions are stable for the session
+        rng = np.random.default_rng(0)
+        planes = rng.standard_normal((LSH_TABLES * LSH_BITS, unit_vec.shape[0])).astype(np.float32)
+        st.session_state.lsh_planes = planes
+    bits = ((planes @ unit_vec) > 0).reshape(LSH_TABLES, LSH_BITS)
+    return (bits @ _LSH_BIT_WEIGHTS).tolist()
+
+def lookup_session_query_cache(collection, query_embedding):
+    """Return (answer, docs) for a near-identical earlier question on this document, or None"""
+    entry = st.session_state.get('session_query_cache', {}).get(collection)
+    if not entry or not entry["items"]:
+        return None
+    q = _unit_vector(query_embedding)
+    # Probe each table's bucket plus its 1-bit Hamming neighbours, then verify the few candidates
+    candidates = set()
+    for table, key in zip(entry["tables"], _lsh_keys(q)):
+        for probe in (key, *(key ^ (1 << j) for j in range(LSH_BITS))):
+            candidates.update(table.get(probe, ()))
+    if not candidates:
+        return None
+    ids = list(candidates)
+    distances = 1.0 - np.stack([entry["items"][i][0] for i in ids]) @ q
+    best = int(np.argmin(distances))
+    if distances[best] <= SESSION_QUERY_CACHE_MAX_DISTANCE:
+        return entry["items"][ids[best]][2]
+    return None
+
+def add_session_query_cache(collection, query_embedding, answer, docs):
+    """Remember an answered question for this session, dropping the oldest past capacity"""
+    cache = st.session_state.setdefault('session_query_cache', {})
+    entry = cache.setdefault(collection, {
+        "items": {},  # id -> (unit vector, LSH keys, (answer, docs)), in insertion order
+        "tables": [{} for _ in range(LSH_TABLES)],  # LSH key -> set of ids
+        "next_id": 0,
+    })
+    q = _unit_vector(query_embedding)
+    keys = _lsh_keys(q)
+    item_id = entry["next_id"]
+    entry["next_id"] += 1
+    entry["items"][item_id] = (q, keys, (answer, docs))
+    for table, key in zip(entry["tables"], keys):
+        table.setdefault(key, set()).add(item_id)
+
+    while len(entry["items"]) > SESSION_QUERY_CACHE_SIZE:
+        old_id = next(iter(entry["items"]))
+        _, old_keys, _ = entry["items"].pop(old_id)
+        for table, key in zip(entry["tables"], old_keys):
+            bucket = table[key]
+            bucket.discard(old_id)
+            if not bucket:
+                del table[key]
+
 def display_process_logs():
     """Display process logs in a dropdown"""
     if st.session_state.process_logs:
@@ -191,8 +400,16 @@ def display_process_logs():
 
 def process_query_with_document(user_input, uploaded_file):
     """Process both document and query together"""
-    # Check if we need to process this document (avoid reprocessing same file)
-    file_hash = get_file_hash(uploaded_file.getbuffer())
+    # Check if we need to process this document (avoid reprocessing same file).
+    # Streamlit gives each upload a stable file_id, so the buffer is hashed once per upload
+    # rather than on every follow-up question.
+    upload_id = getattr(uploaded_file, 'file_id', None)
+    upload_sig = st.session_state.get('uploaded_sig')
+    if upload_id is not None and upload_sig and upload_sig[0] == upload_id:
+        file_hash = upload_sig[1]
+    else:
+        file_hash = get_file_hash(uploaded_file.getbuffer())
+        st.session_state.uploaded_sig = (upload_id, file_hash)
     current_doc_hash = st.session_state.get('current_doc_hash', None)
     
     # Only process document if it's new or changed
@@ -202,24 +419,29 @@ def process_query_with_document(user_input, uploaded_file):
         
         with st.spinner("Processing document and generating response..."):
             try:
-                overall_start = time.time()
+                overall_start = time.perf_counter()
                 
                 # Save uploaded file
-                file_path, unique_filename = save_uploaded_file(uploaded_file)
+                file_path, unique_filename, written = save_uploaded_file(uploaded_file)
                 
                 if not file_path:
                     st.error("Failed to save uploaded file")
                     return
                 
+                # A freshly written file matches the upload hash; a reused same-named file may
+                # differ, so only then hash what is on disk (it is what gets embedded)
+                doc_hash = file_hash[:8] if written else get_file_hash_from_path(file_path)[:8]
+
                 st.session_state.current_document = {
                     'name': uploaded_file.name,
                     'path': file_path,
-                    'unique_name': unique_filename
+                    'unique_name': unique_filename,
+                    'hash': doc_hash,
                 }
                 st.session_state.current_doc_hash = file_hash
                 
                 # Create vector database from document
-                vector_db = create_vector_db_from_document(file_path)
+                vector_db = create_vector_db_from_document(file_path, collection_hash=doc_hash)
                 
                 if not vector_db:
                     st.error("Failed to process the document")
@@ -239,37 +461,78 @@ def process_query_with_document(user_input, uploaded_file):
     else:
         # Document already processed, just handle the query
         if st.session_state.vector_db:
-            process_query(user_input, time.time())
+            process_query(user_input, time.perf_counter())
 
 def process_query(user_input, overall_start):
     """Process query with existing vector database"""
     try:
-        # Load model
-        add_log("Retrieving preloaded model...")
-        llm = preload_model()
-        
-        if llm is None:
-            st.error("Failed to load the language model")
-            return
-
-        # Create retriever and get relevant documents
-        add_log("Setting up document retriever...")
-        retriever = create_fast_retriever(st.session_state.vector_db)
-
-        add_log("Searching for relevant document chunks...")
-        relevant_docs = retriever.get_relevant_documents(user_input)
-        add_log(f"Found {len(relevant_docs)} relevant document chunks")
-        context = format_docs(relevant_docs)
-        
-        # Create chain and generate response
-        add_log("Creating processing chain...")
-        rag_chain = create_chain(llm)
-
-        add_log("Generating response...")
-        response_start = time.time()
-        response = rag_chain.invoke({"context": context, "question": user_input})
-        response_end = time.time()
-        overall_end = time.time()
+        vector_db = st.session_state.vector_db
+        collection = vector_db._collection.name
+
+        embedding = get_embedding_model()
+
+        # Keep the model loading in the background; it is only waited on when neither cache
+        # can answer. The query vector is reused for both caches and the Chroma search.
+        start_model_warmup()
+        add_log("Embedding query...")
+        query_embedding = embedding.embed_query(user_input)
+
+        answered_by_model = False
+
+        # Near-duplicate of a question asked earlier this session: skip retrieval and the LLM
+        session_hit = lookup_session_query_cache(collection, query_embedding)
+        if session_hit is not None:
+            add_log("Similar question asked earlier in this session, reusing its answer and chunks")
+            response_start = time.perf_counter()
+            response, relevant_docs = session_hit
+        else:
+            cache_key = _context_cache_key(vector_db, user_input)
+            cached = get_cached_context(cache_key)
+            if cached is not None:
+                add_log("Repeated query, reusing cached document chunks")
+                context, relevant_docs = cached
+            else:
+                add_log(f"Searching for relevant document chunks (k = {RETRIEVER_K} similarity search)...")
+                relevant_docs = vector_db.similarity_search_by_vector(
+                    query_embedding, k=RETRIEVER_K
+                )
+                context = format_docs(relevant_docs)
+                cache_context(cache_key, context, relevant_docs)
+
+            add_log(f"Found {len(relevant_docs)} relevant document chunks")
+
+            response_start = time.perf_counter()
+            response = get_cached_response(collection, query_embedding)
+            if response is not None:
+                add_log("Similar question answered before, reusing cached response")
+            else:
+                # Load model
+                add_log("Retrieving preloaded model...")
+                llm = preload_model()
+                if llm is None:
+                    st.error("Failed to load the language model")
+                    return
+                # Response time covers generation only, not waiting for the model to load
+                response_start = time.perf_counter()
+
+                # Create chain and generate response
+                add_log("Retrieving processing chain...")
+                rag_chain = get_rag_chain(MODEL_NAME, llm)
+
+                add_log("Generating response...")
+                # Stream tokens as they arrive; the placeholder is cleared afterwards because the
+                # main area renders the full conversation (including this answer) below
+                stream_placeholder = st.empty()
+                with stream_placeholder.container():
+                    with st.chat_message("assistant"):
+                        response = st.write_stream(
+                            rag_chain.stream({"context": context, "question": user_input})
+                        )
+                stream_placeholder.empty()
+                answered_by_model = True
+            add_session_query_cache(collection, query_embedding, response, relevant_docs)
+        response_end = time.perf_counter()
+        overall_end = time.perf_counter()
 
         response_time = response_end - response_start
         total_time = overall_end - overall_start
@@ -301,16 +564,8 @@ def process_query(user_input, overall_start):
                 content = doc.page_content.strip()
                 
                 # Filter out obvious page numbers, table of contents, or meaningless content
-                lines = content.split('\n')
-                cleaned_lines = []
-                
-                for line in lines:
-                    line = line.strip()
-                    # Skip lines that are just numbers, single characters, or very short
-                    if len(line) > 10 and not line.isdigit() and not (len(line) < 5 and line.replace(' ', '').isdigit()):
-                        cleaned_lines.append(line)
-                
-                cleaned_content = '\n'.join(cleaned_lines)
+                # (keeps stripped lines longer than 10 chars that are not just digits)
+                cleaned_content = '\n'.join(_CONTENT_LINE_RE.findall(content))
                 
                 # Show more content but limit for readability
                 if len(cleaned_content) > 800:
@@ -333,12 +588,17 @@ def process_query(user_input, overall_start):
                 st.markdown("---")
         
         # Add to chat history
-        add_to_chat_history(
+        chat_id = add_to_chat_history(
             user_input, 
             response, 
             response_time, 
             st.session_state.current_document['name'] if st.session_state.current_document else "Unknown"
         )
+
+        # Cache the fresh answer under the committed chat_id (a chat created just above included),
+        # so delete_chat_session can purge it later
+        if answered_by_model and chat_id is not None:
+            cache_response(collection, query_embedding, response, chat_id)
         
     except Exception as e:
         error_msg = f"An error occurred during query processing: {str(e)}"
@@ -1,16 +1,12 @@
 import streamlit as st
 import logging
+import os
+import time
 
-from rag_functions import (
-    # Core RAG functions
-    process_query_with_document,
-    process_query,
-    create_vector_db_from_document,
-    # Constants
-    MODEL_NAME,
-    EMBEDDING_MODEL
-)
-from helpers_func import start_new_chat_session, get_chat_sessions, get_chat_messages, get_chat_metadata, delete_chat_session
+# RAG functions (LangChain, Chroma, Ollama) are imported lazily in the branches that use them,
+# so reruns that only browse chat history never load that stack
+from rag_constants import MODEL_NAME, EMBEDDING_MODEL
+from helpers_func import start_new_chat_session, get_chat_sessions, get_chat_messages, get_chat_version, get_chat_metadata, delete_chat_session
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -34,17 +30,25 @@ if 'document_processed' not in st.session_state:
 if 'uploaded_file' not in st.session_state:
     st.session_state.uploaded_file = None
 
-def main():
-    # Page config
-    st.set_page_config(
-        page_title="RAG-Powered Document Assistant",
-        page_icon="📄",
-        layout="wide"
-    )
-
-    # Custom styling with radio button styling
-    st.markdown(
-        """
+def snippet(text):
+    """One-line preview of a chat's last answer for the sidebar"""
+    return (text or "").replace("\n", " ")[:50]
+
+@st.cache_data(ttl=5)
+def _sessions_and_labels():
+    """Chat sessions plus their sidebar labels; cleared whenever chats or messages change."""
+    sessions = get_chat_sessions()
+    labels = [f"Chat {s['id']}, {(s.get('document_display_name') or 'no-document')} — {snippet(s.get('last_answer'))}..." for s in sessions]
+    return sessions, labels
+
+# Each new message creates a new (chat_id, version) key, so bound the cache
+@st.cache_data(ttl=30, max_entries=32)
+def _cached_messages(chat_id, version):
+    """Messages for a chat; version (latest message id) changes whenever a message is added."""
+    return get_chat_messages(chat_id)
+
+# Page-wide custom CSS
+_CSS_BLOCK = """
         <style>
         .custom-div {
             background-color: #E3E3E312; 
@@ -60,10 +64,38 @@ def main():
         border-radius: 6px;
         }
         </style>
-        """,
-        unsafe_allow_html=True
+        """
+
+# Sidebar system-info card; the model names are constants, so it is formatted once at import
+_SYSINFO_HTML = f"""
+            <div class="custom-div">
+                <b>SYSTEM INFO</b><br>
+                Model: <code>{MODEL_NAME}</code> <br>
+                Embedding: <code>{EMBEDDING_MODEL}</code>
+            </div>
+            """
+
+def _render_convo(msgs):
+    """Conversation as a single markdown string; msgs is a tuple of (question, answer) pairs"""
+    parts = []
+    for question, answer in msgs:
+        if question:
+            parts.append(f"**You:** {question}")
+        if answer:
+            parts.append(f"**Assistant:** {answer}")
+    return "\n\n".join(parts)
+
+def main():
+    # Page config
+    st.set_page_config(
+        page_title="RAG-Powered Document Assistant",
+        page_icon="📄",
+        layout="wide"
     )
 
+    # Custom styling with radio button styling
+    st.markdown(_CSS_BLOCK, unsafe_allow_html=True)
+
     # File uploader with better styling
     uploaded_file = st.file_uploader(
         "🔗 Upload a document (PDF, CSV, JSON, TXT)",
@@ -81,29 +113,41 @@ def main():
 
     # Process when both file and query are provided
     if user_input and uploaded_file:
+        from rag_functions import process_query_with_document
         process_query_with_document(user_input, uploaded_file)
+        _sessions_and_labels.clear()
     elif user_input and st.session_state.get('vector_db') is not None:
         # Allow follow-up queries without re-uploading if a vector DB is active
-        process_query(user_input, overall_start:=__import__('time').time())
-
-    # Always render full conversation for active chat in main area
-    active_msgs = []
-    if st.session_state.get('chat_id') is not None:
-        try:
-            active_msgs = get_chat_messages(st.session_state.chat_id)
-        except Exception:
-            active_msgs = []
-    elif st.session_state.get('chat_history'):
-        active_msgs = st.session_state.chat_history
-
-    if active_msgs:
+        from rag_functions import process_query
+        process_query(user_input, time.perf_counter())
+        _sessions_and_labels.clear()
+
+    # Always render full conversation for active chat in main area.
+    # It only changes on a submitted question or a chat switch; other reruns re-emit the last render.
+    active_chat_id = st.session_state.get('chat_id')
+    if (
+        user_input
+        or active_chat_id != st.session_state.get('_convo_chat_id')
+        or '_last_convo_md' not in st.session_state
+    ):
+        active_msgs = []
+        if active_chat_id is not None:
+            try:
+                active_msgs = _cached_messages(active_chat_id, get_chat_version(active_chat_id))
+            except Exception:
+                active_msgs = []
+        elif st.session_state.get('chat_history'):
+            active_msgs = st.session_state.chat_history
+        msgs = tuple((m.get('question'), m.get('answer')) for m in active_msgs)
+        st.session_state._last_convo_md = _render_convo(msgs) if msgs else ""
+        st.session_state._convo_chat_id = active_chat_id
+
+    if st.session_state._last_convo_md:
         st.markdown('<div class="glass-card">', unsafe_allow_html=True)
         st.subheader("Conversation")
-        for msg in active_msgs:
-            if msg.get('question'):
-                st.chat_message("user").write(msg['question'])
-            if msg.get('answer'):
-                st.chat_message("assistant").write(msg['answer'])
+        # One markdown element for the whole conversation instead of two chat_message blocks per turn
+        with st.container():
+            st.markdown(st.session_state._last_convo_md)
         st.markdown('</div>', unsafe_allow_html=True)
 
     # Sidebar with chat history and system info
@@ -114,44 +158,54 @@ def main():
         if st.button("New Chat ✚", use_container_width=False):
             new_id = start_new_chat_session()
             st.session_state.chat_id = new_id
+            _sessions_and_labels.clear()
             st.rerun()
 
         
-        # Chat History (list with selection + snippet). Selecting opens full conversation in main area.
-        col_h, col_d = st.columns(2)
+        # Chat History (list with selection + snippet). Opening a chat shows full conversation in main area.
+        st.subheader("Chat History")
 
-        with col_h:
-            st.subheader("Chat History")
-        with col_d:
-            if st.button("Delete", icon=":material/delete:"):
-                try:
-                    delete_chat_session(st.session_state.chat_id)
-                    st.session_state.chat_id = None
-                    st.session_state.chat_history = []
-                    st.rerun()
-                except Exception:
-                    pass
-
-        sessions = get_chat_sessions()
+        sessions, labels = _sessions_and_labels()
         if sessions:
             # Radio to select active chat with last-answer snippet
-            def snippet(text):
-                return (text or "").replace("\n", " ")[:50]
-            labels = [f"Chat {s['id']}, {(s.get('document_display_name') or 'no-document')} — {snippet(s.get('last_answer'))}..." for s in sessions]
             ids = [s['id'] for s in sessions]
+            id_to_idx = {chat_id: idx for idx, chat_id in enumerate(ids)}
+            label_to_idx = {label: idx for idx, label in enumerate(labels)}
             current_id = st.session_state.get('chat_id')
-            default_index = ids.index(current_id) if current_id in ids else 0
-            selected_label = st.radio("Select a chat", labels, index=default_index, key="chat_select")
-            selected_idx = labels.index(selected_label)
+            default_index = id_to_idx.get(current_id, 0)
+            # Inside a form, picking a chat doesn't rerun the app until Open/Delete is pressed
+            with st.form("history_form", border=False):
+                selected_label = st.radio("Select a chat", labels, index=default_index, key="chat_select")
+                col_o, col_d = st.columns(2)
+                with col_o:
+                    open_clicked = st.form_submit_button("Open", icon=":material/chat:")
+                with col_d:
+                    delete_clicked = st.form_submit_button("Delete", icon=":material/delete:")
+            selected_idx = label_to_idx[selected_label]
             selected_id = ids[selected_idx]
-            if current_id != selected_id:
+
+            if delete_clicked:
+                try:
+                    delete_chat_session(selected_id)
+                    _sessions_and_labels.clear()
+                    if selected_id == current_id:
+                        st.session_state.chat_id = None
+                        st.session_state.chat_history = []
+                    st.rerun()
+                except Exception:
+                    pass
+            # With no active chat, open the selected (newest) one right away as before
+            elif (open_clicked or current_id is None) and current_id != selected_id:
                 st.session_state.chat_id = selected_id
                 # Restore document and vector DB
                 meta = get_chat_metadata(selected_id)
                 if meta and meta.get('path'):
                     st.session_state.current_document = meta
                     try:
-                        vdb = create_vector_db_from_document(meta['path'])
+                        from rag_functions import get_vector_db_for_path
+                        vdb = get_vector_db_for_path(
+                            meta['path'], os.path.getmtime(meta['path']), EMBEDDING_MODEL, meta.get('hash')
+                        )
                         if vdb:
                             st.session_state.vector_db = vdb
                             st.session_state.document_processed = True
@@ -163,17 +217,8 @@ def main():
             st.caption("There's no any chat history...")
          
         # using custom styled div
-        st.markdown(
-            f"""
-            <div class="custom-div">
-                <b>SYSTEM INFO</b><br>
-                Model: <code>{MODEL_NAME}</code> <br>
-                Embedding: <code>{EMBEDDING_MODEL}</code>
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
-        
+        st.markdown(_SYSINFO_HTML, unsafe_allow_html=True)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file